@@ -36,6 +36,7 @@ from .helpers.profiles import (
     ProfilePitch,
     TaskCaller,
 )
+from .lookup_dialog import clear_cached_html
 from .note_types import ensure_imports_added
 from .pitch_accents.user_accents import UserAccentData
 from .reading import acc_dict
@@ -647,6 +648,7 @@ class SettingsDialog(QDialog, MgrPropMixIn):
         self._accents_override.save_to_disk()
         # Reload
         acc_dict.reload_from_disk()
+        clear_cached_html()
         aud_src_mgr.init_sources(on_finish=show_audio_init_result_tooltip)
         # if new profiles were added, add imports to the note types.
         ensure_imports_added()
@@ -677,9 +679,18 @@ def add_deck_download_action(root_menu: QMenu):
     root_menu.addAction(menu_action)
 
 
+def on_config_updated_from_addon_manager(new_conf: dict) -> None:
+    """
+    Called when the config is changed in Anki's add-on config editor,
+    including the editor opened with the "Advanced" button.
+    """
+    cfg.update_from_addon_manager(new_conf)
+    clear_cached_html()
+
+
 def init():
     root_menu = menu_root_entry()
     add_settings_action(root_menu)
     add_deck_download_action(root_menu)
     set_config_action(lambda: SettingsDialog(mw))
-    set_config_update_action(cfg.update_from_addon_manager)
+    set_config_update_action(on_config_updated_from_addon_manager)
@@ -1,19 +1,21 @@
 # Copyright: Ren Tatsumoto <tatsu at autistici.org> and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+import atexit
 import contextlib
+import functools
+import itertools
 import os
 import sqlite3
-from collections.abc import Iterable, Sequence
+import threading
+from collections.abc import Iterable, Iterator, Sequence
 from contextlib import contextmanager
-from typing import NamedTuple, Optional
+from typing import Callable, NamedTuple, Optional
 
-from .audio_json_schema import FileInfo, SourceIndex
+from .audio_json_schema import FileInfo, FileList, SourceIndex, SourceMeta
 from .file_ops import user_files_dir
 from .sqlite_schema import CURRENT_DB
 
-NoneType = type(None)  # fix for the official binary bundle
-
 CURRENT_DB.remove_deprecated_files()
 
 
@@ -27,8 +29,94 @@ class BoundFile(NamedTuple):
     source_name: str
 
 
-def build_or_clause(repeated_field_name: str, count: int) -> str:
-    return " OR ".join(f"{repeated_field_name} = ?" for _idx in range(count))
+# Queries used on hot lookup paths.
+# sqlite3 keeps compiled statements in a per-connection cache keyed by the query text.
+QUERY_GET_MEDIA_DIR_ABS = """ SELECT media_dir_abs FROM meta WHERE source_name = ? LIMIT 1; """
+QUERY_GET_MEDIA_DIR_REL = """ SELECT media_dir FROM meta WHERE source_name = ? LIMIT 1; """
+QUERY_GET_ORIGINAL_URL = """ SELECT original_url FROM meta WHERE source_name = ? LIMIT 1; """
+QUERY_SEARCH_FILES_IN_SOURCE = """
+SELECT file_name FROM headwords
+WHERE source_name = ? AND headword = ?;
+"""
+QUERY_SEARCH_FILES = """
+SELECT file_name, source_name FROM headwords
+WHERE headword = ?;
+"""
+QUERY_GET_FILE_INFO = """
+SELECT kana_reading, pitch_pattern, pitch_number FROM files
+WHERE source_name = ? AND file_name = ?
+LIMIT 1;
+"""
+
+RowFactory = Callable[[sqlite3.Cursor, tuple], BoundFile]
+
+
+def bound_file_factory(source_name: Optional[str], headword: str) -> RowFactory:
+    """
+    Build BoundFile objects while sqlite3 fetches rows.
+    If source_name is None, it is expected to be the second column of the row.
+    """
+    if source_name is None:
+        return lambda _cur, row: BoundFile(headword=headword, file_name=row[0], source_name=row[1])
+    return lambda _cur, row: BoundFile(headword=headword, file_name=row[0], source_name=source_name)
+
+
+def build_in_clause(count: int) -> str:
+    return "IN (" + ", ".join("?" for _idx in range(count)) + ")"
+
+
+@functools.lru_cache(maxsize=128)
+def distinct_file_count_sql(count: int) -> str:
+    # Filenames in different audio sources may collide,
+    # although it's not likely with the currently released audio sources.
+    # To resolve collisions when counting distinct filenames,
+    # dictionary name and year are also taken into account.
+    return f"""
+        SELECT COUNT(*) FROM (
+            SELECT DISTINCT f.file_name, m.dictionary_name, m.year FROM files f
+            INNER JOIN meta m ON f.source_name = m.source_name
+            WHERE f.source_name {build_in_clause(count)}
+        );
+    """
+
+
+@functools.lru_cache(maxsize=128)
+def distinct_headword_count_sql(count: int) -> str:
+    return f"""
+        SELECT COUNT(*) FROM (
+            SELECT DISTINCT headword FROM headwords
+            WHERE source_name {build_in_clause(count)}
+        );
+    """
+
+
+# Older versions of sqlite limit the number of bound parameters to 999.
+SQLITE_MAX_VARIABLE_NUMBER = 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+INSERT_CHUNK_ROWS = 500
+
+
+def iter_chunks(rows: Iterable[tuple], size: int) -> Iterable[tuple[tuple, ...]]:
+    rows = iter(rows)
+    while chunk := tuple(itertools.islice(rows, size)):
+        yield chunk
+
+
+def build_values_clause(col_count: int, row_count: int) -> str:
+    row = "(" + ", ".join("?" for _idx in range(col_count)) + ")"
+    return ", ".join(row for _idx in range(row_count))
+
+
+def insert_rows(cur: sqlite3.Cursor, query: str, col_count: int, rows: Iterable[tuple]) -> None:
+    """
+    Insert rows using multi-row "INSERT ... VALUES (...), (...)" statements.
+    The query must end with "VALUES".
+    """
+    chunk_size = min(INSERT_CHUNK_ROWS, SQLITE_MAX_VARIABLE_NUMBER // col_count)
+    for chunk in iter_chunks(rows, chunk_size):
+        cur.execute(
+            f"{query} {build_values_clause(col_count, len(chunk))};",
+            tuple(itertools.chain.from_iterable(chunk)),
+        )
 
 
 class Sqlite3Buddy:
@@ -36,6 +124,28 @@ class Sqlite3Buddy:
 
     _db_path: str = os.path.join(user_files_dir(), CURRENT_DB.name)
     _con: Optional[sqlite3.Connection]
+    # Connections stay open after a session ends and are handed to the next session, in any thread.
+    # Only one session uses a connection at a time.
+    # Each pooled connection maps to the database file epoch it was opened in.
+    _connections: dict[sqlite3.Connection, int] = {}
+    _idle_connections: list[sqlite3.Connection] = []
+    _pool_lock = threading.Lock()
+    # Incremented by `remove_database_file()`.
+    # Sessions whose connections were opened before that keep using the deleted file until they end.
+    _db_epoch: int = 0
+    # Names of fully cached audio sources, shared by all sessions. None means it has to be queried again.
+    # The generation changes whenever the set is invalidated, so that stale results aren't stored.
+    _cached_sources: Optional[frozenset[str]] = None
+    _cached_sources_gen: int = 0
+    _cached_sources_lock = threading.Lock()
+    # Applied once to every new connection.
+    _startup_pragmas: str = """
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        PRAGMA mmap_size = 268435456;
+        PRAGMA cache_size = -32768;
+        PRAGMA temp_store = MEMORY;
+    """
 
     def __init__(self) -> None:
         self._con = None
@@ -46,111 +156,245 @@ class Sqlite3Buddy:
     def start_session(self) -> None:
         if self.can_execute():
             self.end_session()
-        self._con: sqlite3.Connection = sqlite3.connect(self._db_path)
-        self._prepare_tables()
+        with self._pool_lock:
+            if self._idle_connections:
+                self._con = self._idle_connections.pop()
+                return
+            epoch = self._db_epoch
+        self._con = sqlite3.connect(
+            self._db_path,
+            check_same_thread=False,
+            cached_statements=256,
+            # Transactions are started explicitly. See `_transaction()`.
+            isolation_level=None,
+        )
+        try:
+            self._set_file_format()
+            self._con.executescript(self._startup_pragmas)
+            self._prepare_tables()
+        except BaseException:
+            # The session never started, so `end_session()` won't run. Don't leak the connection.
+            self._con.close()
+            self._con = None
+            raise
+        with self._pool_lock:
+            # If the database file was removed while connecting, the connection isn't pooled
+            # and is closed when the session ends.
+            if epoch == self._db_epoch:
+                self._connections[self._con] = epoch
 
     def end_session(self) -> None:
-        if self.can_execute():
-            self._con.commit()
-            self._con.close()
+        if not self.can_execute():
+            return
+        con, reusable = self._con, False
+        try:
+            with self._pool_lock:
+                # The connection may have been dropped from the pool by `remove_database_file()`
+                # or closed by `close_all_connections()` while this session was running.
+                is_pooled = con in self._connections
+            if is_pooled and con.in_transaction:
+                con.rollback()
+            reusable = is_pooled
+        finally:
             self._con = None
+            with self._pool_lock:
+                if reusable and con in self._connections:
+                    self._idle_connections.append(con)
+                else:
+                    # Closing discards an unfinished transaction. Closing twice is a no-op.
+                    self._connections.pop(con, None)
+                    con.close()
+
+    @classmethod
+    def close_all_connections(cls) -> None:
+        with cls._pool_lock:
+            for con in cls._connections:
+                con.close()
+            cls._connections.clear()
+            cls._idle_connections.clear()
+
+    @classmethod
+    def _close_idle_connections(cls) -> None:
+        """
+        Close connections that aren't used by any session and start a new database file epoch.
+        Connections used by running sessions are removed from the pool and closed when their sessions end.
+        """
+        with cls._pool_lock:
+            for con in cls._idle_connections:
+                con.close()
+            cls._connections.clear()
+            cls._idle_connections.clear()
+            cls._db_epoch += 1
+
+    def _uses_current_db(self) -> bool:
+        """False if the database file was removed after this session's connection was opened."""
+        with self._pool_lock:
+            return self._connections.get(self._con) == self._db_epoch
 
     @classmethod
     def remove_database_file(cls):
-        with contextlib.suppress(FileNotFoundError):
-            os.remove(cls._db_path)
+        cls._close_idle_connections()
+        # Sqlite normally deletes the WAL files when the last connection closes.
+        for path in (cls._db_path, f"{cls._db_path}-wal", f"{cls._db_path}-shm"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        cls._invalidate_cached_sources()
 
-    def get_media_dir_abs(self, source_name: str) -> Optional[str]:
+    @classmethod
+    def _invalidate_cached_sources(cls) -> None:
+        """Must be called after changes to audio sources have been committed."""
+        with cls._cached_sources_lock:
+            cls._cached_sources = None
+            cls._cached_sources_gen += 1
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Run the enclosed statements in one transaction.
+        Roll back if an exception occurs.
+        """
         cur = self._con.cursor()
-        query = """ SELECT media_dir_abs FROM meta WHERE source_name = ? LIMIT 1; """
-        result = cur.execute(query, (source_name,)).fetchone()
-        assert type(result) is tuple and len(result) == 1 and (type(result[0]) in (str, NoneType))
-        return result[0]
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK;")
+            raise
+        else:
+            cur.execute("COMMIT;")
+
+    def get_media_dir_abs(self, source_name: str) -> Optional[str]:
+        (result,) = self._con.execute(QUERY_GET_MEDIA_DIR_ABS, (source_name,)).fetchone()
+        return result
 
     def get_media_dir_rel(self, source_name: str) -> str:
-        cur = self._con.cursor()
-        query = """ SELECT media_dir FROM meta WHERE source_name = ? LIMIT 1; """
-        result = cur.execute(query, (source_name,)).fetchone()
-        assert len(result) == 1 and type(result[0]) is str
-        return result[0]
+        (result,) = self._con.execute(QUERY_GET_MEDIA_DIR_REL, (source_name,)).fetchone()
+        return result
 
     def get_original_url(self, source_name: str) -> Optional[str]:
-        cur = self._con.cursor()
-        query = """ SELECT original_url FROM meta WHERE source_name = ? LIMIT 1; """
-        result = cur.execute(query, (source_name,)).fetchone()
-        assert len(result) == 1 and (type(result[0]) in (str, NoneType))
-        return result[0]
+        (result,) = self._con.execute(QUERY_GET_ORIGINAL_URL, (source_name,)).fetchone()
+        return result
 
     def set_original_url(self, source_name: str, new_url: str) -> None:
         cur = self._con.cursor()
         query = """ UPDATE meta SET original_url = ? WHERE source_name = ?; """
         cur.execute(query, (new_url, source_name))
-        self._con.commit()
 
     def is_source_cached(self, source_name: str) -> bool:
         """True if audio source with this name has been cached already."""
-        cur = self._con.cursor()
-        queries = (
-            """ SELECT 1 FROM meta      WHERE source_name = ? LIMIT 1; """,
-            """ SELECT 1 FROM headwords WHERE source_name = ? LIMIT 1; """,
-            """ SELECT 1 FROM files     WHERE source_name = ? LIMIT 1; """,
-        )
-        return all(cur.execute(query, (source_name,)).fetchone() is not None for query in queries)
+        return source_name in self._get_cached_sources()
+
+    def _get_cached_sources(self) -> frozenset[str]:
+        cls = type(self)
+        with cls._cached_sources_lock:
+            cached, gen = cls._cached_sources, cls._cached_sources_gen
+        # A session still using a removed database file must neither read nor fill the shared set.
+        # Checked after reading the generation, which `remove_database_file()` changes after the epoch.
+        is_current = self._uses_current_db()
+        if not is_current:
+            cached = None
+        if cached is None:
+            cur = self._con.cursor()
+            query = """
+            SELECT m.source_name FROM meta m
+            WHERE EXISTS (SELECT 1 FROM headwords h WHERE h.source_name = m.source_name)
+            AND EXISTS (SELECT 1 FROM files f WHERE f.source_name = m.source_name);
+            """
+            cached = frozenset(row[0] for row in cur.execute(query))
+            with cls._cached_sources_lock:
+                if is_current and cls._cached_sources_gen == gen:
+                    cls._cached_sources = cached
+        return cached
 
     def insert_data(self, source_name: str, data: SourceIndex):
-        cur = self._con.cursor()
-        query = """
-        INSERT INTO meta
-        (source_name, dictionary_name, year, version, original_url, media_dir, media_dir_abs)
-        VALUES(?, ?, ?, ?, ?, ?, ?);
-        """
-        # Insert meta.
-        cur.execute(
-            query,
-            (
-                source_name,
-                data["meta"]["name"],
-                data["meta"]["year"],
-                data["meta"]["version"],
-                None,
-                data["meta"]["media_dir"],
-                data["meta"].get("media_dir_abs"),  # Possibly unset
-            ),
+        self.insert_data_iter(
+            source_name,
+            meta=data["meta"],
+            headwords=data["headwords"].items(),
+            files=data["files"].items(),
         )
-        # Insert headwords and file names
-        query = """
-            INSERT INTO headwords
-            (source_name, headword, file_name)
-            VALUES(?, ?, ?);
-            """
-        cur.executemany(
-            query,
-            (
-                (source_name, headword, file_name)
-                for headword, file_list in data["headwords"].items()
-                for file_name in file_list
-            ),
-        )
-        # Insert readings and accent info.
-        query = """
-            INSERT INTO files
-            ( source_name, file_name, kana_reading, pitch_pattern, pitch_number )
-            VALUES(?, ?, ?, ?, ?);
+
+    def insert_data_iter(
+        self,
+        source_name: str,
+        meta: SourceMeta,
+        headwords: Iterable[tuple[str, FileList]],
+        files: Iterable[tuple[str, FileInfo]],
+    ) -> None:
         """
-        cur.executemany(
-            query,
-            (
+        Insert an audio source, consuming headwords and files lazily.
+        Rows are written in fixed-size chunks, so the iterables may be streamed.
+        """
+        with self._transaction() as cur:
+            query = """
+            INSERT INTO meta
+            (source_name, dictionary_name, year, version, original_url, media_dir, media_dir_abs)
+            VALUES(?, ?, ?, ?, ?, ?, ?);
+            """
+            # Insert meta.
+            cur.execute(
+                query,
                 (
                     source_name,
-                    file_name,
-                    file_info["kana_reading"],
-                    file_info.get("pitch_pattern"),
-                    file_info.get("pitch_number"),
-                )
-                for file_name, file_info in data["files"].items()
-            ),
-        )
-        self._con.commit()
+                    meta["name"],
+                    meta["year"],
+                    meta["version"],
+                    None,
+                    meta["media_dir"],
+                    meta.get("media_dir_abs"),  # Possibly unset
+                ),
+            )
+            # Insert headwords and file names
+            query = """
+                INSERT INTO headwords
+                (source_name, headword, file_name)
+                VALUES
+                """
+            insert_rows(
+                cur=cur,
+                query=query,
+                col_count=3,
+                rows=(
+                    (source_name, headword, file_name)
+                    for headword, file_list in headwords
+                    for file_name in file_list
+                ),
+            )
+            # Insert readings and accent info.
+            query = """
+                INSERT INTO files
+                ( source_name, file_name, kana_reading, pitch_pattern, pitch_number )
+                VALUES
+            """
+            insert_rows(
+                cur=cur,
+                query=query,
+                col_count=5,
+                rows=(
+                    (
+                        source_name,
+                        file_name,
+                        file_info["kana_reading"],
+                        file_info.get("pitch_pattern"),
+                        file_info.get("pitch_number"),
+                    )
+                    for file_name, file_info in files
+                ),
+            )
+        self._invalidate_cached_sources()
+
+    def _set_file_format(self) -> None:
+        """
+        Configure a newly created database file.
+        Must run before anything else writes to the file.
+        """
+        cur = self._con.cursor()
+        if cur.execute("PRAGMA page_count;").fetchone()[0] == 0:
+            # Larger pages mean fewer reads per lookup. Must be set before auto_vacuum.
+            cur.execute("PRAGMA page_size = 8192;")
+            # Allow returning free pages to the OS after an audio source is removed.
+            cur.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        cur.close()
 
     def _prepare_tables(self):
         cur = self._con.cursor()
@@ -196,103 +440,84 @@ class Sqlite3Buddy:
             CREATE INDEX IF NOT EXISTS index_names ON meta(source_name);
         """
         )
+        # Indexes include the selected columns (covering indexes),
+        # so that lookups are answered from the index without reading the table.
+        # Drop non-covering indexes created by older versions of the add-on.
         cur.execute(
             """
-            CREATE INDEX IF NOT EXISTS index_file_names ON headwords(source_name, headword);
+            DROP INDEX IF EXISTS index_file_names;
         """
         )
         cur.execute(
             """
-            CREATE INDEX IF NOT EXISTS index_file_info ON files(source_name, file_name);
+            DROP INDEX IF EXISTS index_file_info;
+        """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS index_file_names_cov ON headwords(source_name, headword, file_name);
+        """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS index_file_info_cov
+            ON files(source_name, file_name, kana_reading, pitch_pattern, pitch_number);
         """
         )
-
-        self._con.commit()
         cur.close()
 
-    def search_files_in_source(self, source_name: str, headword: str) -> Iterable[BoundFile]:
+    def search_files_in_source(self, source_name: str, headword: str) -> list[BoundFile]:
         cur = self._con.cursor()
-        query = """
-        SELECT file_name FROM headwords
-        WHERE source_name = ? AND headword = ?;
-        """
-        results = cur.execute(query, (source_name, headword)).fetchall()
-        assert type(results) is list
-        return (
-            BoundFile(file_name=result_tup[0], source_name=source_name, headword=headword) for result_tup in results
-        )
+        cur.row_factory = bound_file_factory(source_name=source_name, headword=headword)
+        # Fetch everything while the session owns the connection.
+        # A pending cursor must not outlive the session since pooled connections are shared between threads.
+        return cur.execute(QUERY_SEARCH_FILES_IN_SOURCE, (source_name, headword)).fetchall()
 
-    def search_files(self, headword: str) -> Iterable[BoundFile]:
+    def search_files(self, headword: str) -> list[BoundFile]:
         cur = self._con.cursor()
-        query = """
-        SELECT file_name, source_name FROM headwords
-        WHERE headword = ?;
-        """
-        results = cur.execute(query, (headword,)).fetchall()
-        assert type(results) is list
-        return (
-            BoundFile(file_name=result_tup[0], source_name=result_tup[1], headword=headword) for result_tup in results
-        )
+        cur.row_factory = bound_file_factory(source_name=None, headword=headword)
+        return cur.execute(QUERY_SEARCH_FILES, (headword,)).fetchall()
 
     def get_file_info(self, source_name: str, file_name: str) -> FileInfo:
-        cur = self._con.cursor()
-        query = """
-        SELECT kana_reading, pitch_pattern, pitch_number FROM files
-        WHERE source_name = ? AND file_name = ?
-        LIMIT 1;
-        """
-        result = cur.execute(query, (source_name, file_name)).fetchone()
-        assert len(result) == 3 and all((type(val) in (str, NoneType)) for val in result)
+        kana_reading, pitch_pattern, pitch_number = self._con.execute(
+            QUERY_GET_FILE_INFO,
+            (source_name, file_name),
+        ).fetchone()
         return {
-            "kana_reading": result[0],
-            "pitch_pattern": result[1],
-            "pitch_number": result[2],
+            "kana_reading": kana_reading,
+            "pitch_pattern": pitch_pattern,
+            "pitch_number": pitch_number,
         }
 
     def remove_data(self, source_name: str):
         """
         Remove all info about audio source from the database.
         """
-        cur = self._con.cursor()
         queries = (
             """ DELETE FROM meta      WHERE source_name = ?; """,
             """ DELETE FROM headwords WHERE source_name = ?; """,
             """ DELETE FROM files     WHERE source_name = ?; """,
         )
-        for query in queries:
-            cur.execute(query, (source_name,))
-        self._con.commit()
+        with self._transaction() as cur:
+            for query in queries:
+                cur.execute(query, (source_name,))
+        self._invalidate_cached_sources()
+        # Shrink the file. Costs time proportional to the number of freed pages, not to the file size.
+        # executescript() steps the pragma to completion, while execute() would only free one page.
+        self._con.executescript("PRAGMA incremental_vacuum;")
 
     def distinct_file_count(self, source_names: Sequence[str]) -> int:
         if not source_names:
             return 0
         cur = self._con.cursor()
-        # Filenames in different audio sources may collide,
-        # although it's not likely with the currently released audio sources.
-        # To resolve collisions when counting distinct filenames,
-        # dictionary name and year are also taken into account.
-        query = """
-            SELECT COUNT(*) FROM (
-                SELECT DISTINCT f.file_name, m.dictionary_name, m.year FROM files f
-                INNER JOIN meta m ON f.source_name = m.source_name
-                WHERE %s
-            );
-        """
-        return cur.execute(
-            query % build_or_clause("f.source_name", len(source_names)),
-            source_names,
-        ).fetchone()[0]
+        return cur.execute(distinct_file_count_sql(len(source_names)), source_names).fetchone()[0]
 
     def distinct_headword_count(self, source_names: Sequence[str]) -> int:
         if not source_names:
             return 0
         cur = self._con.cursor()
-        query = """ SELECT COUNT(*) FROM (SELECT DISTINCT headword FROM headwords WHERE %s); """
         # Return the number of unique headwords in the specified sources.
-        return cur.execute(
-            query % build_or_clause("source_name", len(source_names)),
-            source_names,
-        ).fetchone()[0]
+        return cur.execute(distinct_headword_count_sql(len(source_names)), source_names).fetchone()[0]
 
     def source_names(self) -> list[str]:
         cur = self._con.cursor()
@@ -300,11 +525,15 @@ class Sqlite3Buddy:
         return [result_tuple[0] for result_tuple in query_result]
 
 
+atexit.register(Sqlite3Buddy.close_all_connections)
+
+
 @contextmanager
 def sqlite3_buddy():
     """
-    Create, use, then clean up a temporary connection.
-    Use when working in a different thread since the same connection can't be reused in another thread.
+    Start, use, then end a session.
+    Use when working in a different thread since the same connection can't be used by two threads at once.
+    The connection is taken from a pool of idle connections and returned to it when the session ends.
     """
     ins = Sqlite3Buddy()
     ins.start_session()
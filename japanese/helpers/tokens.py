@@ -2,33 +2,47 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import re
-from collections.abc import Iterable, Sequence
+from collections.abc import Iterable
 
 RE_FLAGS = re.MULTILINE | re.IGNORECASE
 HTML_AND_MEDIA_REGEX = re.compile(
     r"<[^<>]+>|\[sound:[^\[\]]+]",
     flags=RE_FLAGS,
 )
+# Reference: https://stackoverflow.com/questions/15033196/
+# Added arabic numbers.
+JP_CHAR_CLASS = r"\u3000-\u303f\u3040-\u309f\u30a0-\u30ff\uff66-\uff9f\u4e00-\u9fff\u3400-\u4dbf０-９0-9"
 RE_NON_JP = re.compile(
-    # Reference: https://stackoverflow.com/questions/15033196/
-    # Added arabic numbers.
-    r"[^\u3000-\u303f\u3040-\u309f\u30a0-\u30ff\uff66-\uff9f\u4e00-\u9fff\u3400-\u4dbf０-９0-9]+",
+    rf"[^{JP_CHAR_CLASS}]+",
     flags=RE_FLAGS,
 )
-RE_JP_SEP = re.compile(
-    # Reference: https://wikiless.org/wiki/List_of_Japanese_typographic_symbols
-    r"[\r\n\t仝　 ・、※【】「」〒◎×〃゜『』《》～〜~〽,.。〄〇〈〉〓〔〕〖〗〘〙〚〛〝〞〟〠〡〢〣〥〦〧〨〭〮〯〫〬〶〷〸〹〺〻〼〾〿！？…ヽヾゞ〱〲〳〵〴（）［］｛｝｟｠゠＝‥•◦﹅﹆＊♪♫♬♩ⓍⓁⓎ]+",
-    flags=RE_FLAGS,
+# Reference: https://wikiless.org/wiki/List_of_Japanese_typographic_symbols
+JP_SEPARATORS = (
+    "\r\n\t仝　 ・、※【】「」〒◎×〃゜『』《》～〜~〽,.。〄〇〈〉〓〔〕〖〗〘〙〚〛〝〞〟〠〡〢〣〥〦〧〨〭〮〯"
+    "〫〬〶〷〸〹〺〻〼〾〿！？…ヽヾゞ〱〲〳〵〴（）［］｛｝｟｠゠＝‥•◦﹅﹆＊♪♫♬♩ⓍⓁⓎ"
 )
 RE_COUNTERS = re.compile(
     r"([0-9０-９一二三四五六七八九十零]{1,4}(?:万人|ヶ月|[つ月日人筋隻丁品番枚時回円万歳限]))", flags=RE_FLAGS
 )
-RE_NON_JP_PARSED = re.compile(
-    r"<no-jp>(?P<token>.*?)</no-jp>",
+RE_FURIGANA = re.compile(
+    r" *([^ \[\]]+)\[[^\[\]]+]",
+    flags=RE_FLAGS,
+)
+# Separators that are left in text after runs of non-Japanese characters are split off.
+JP_SEPARATORS_IN_JP_TEXT = "".join(char for char in JP_SEPARATORS if not RE_NON_JP.match(char))
+# Runs of characters that separate words: anything non-Japanese, and Japanese separators.
+RE_SEPARATORS = re.compile(
+    rf"(?:[^{JP_CHAR_CLASS}]|[{re.escape(JP_SEPARATORS_IN_JP_TEXT)}])+",
     flags=RE_FLAGS,
 )
-RE_NON_JP_PART = re.compile(
-    r"(<no-jp>.*?</no-jp>)",
+# Matches everything that mecab shouldn't parse, in one pass:
+# HTML tags and media, runs of non-Japanese characters, and runs of Japanese separators.
+# HTML takes precedence, so runs of non-Japanese characters stop where a tag begins.
+# Text between matches is Japanese and can be parsed.
+RE_NOT_PARSEABLE = re.compile(
+    rf"{HTML_AND_MEDIA_REGEX.pattern}"
+    rf"|(?:(?!{HTML_AND_MEDIA_REGEX.pattern})[^{JP_CHAR_CLASS}])+"
+    rf"|[{re.escape(JP_SEPARATORS_IN_JP_TEXT)}]+",
     flags=RE_FLAGS,
 )
 
@@ -51,27 +65,12 @@ class ParseableToken(Token):
 
 def split_separators(expr: str) -> list[str]:
     """Split text by common separators (like / or ・) into separate words that can be looked up."""
-
-    # Replace all typical separators with a space
-    expr = re.sub(RE_NON_JP, " ", expr)  # Remove non-Japanese characters
-    expr = re.sub(RE_JP_SEP, " ", expr)  # Remove Japanese punctuation
-    return expr.split(" ")
+    return [part for part in RE_SEPARATORS.split(expr) if part]
 
 
 def clean_furigana(expr: str) -> str:
     """Remove text in [] used to represent furigana."""
-    return re.sub(r" *([^ \[\]]+)\[[^\[\]]+]", r"\g<1>", expr, flags=RE_FLAGS)
-
-
-def mark_non_jp_token(m: re.Match) -> str:
-    return "<no-jp>" + m.group() + "</no-jp>"
-
-
-def parts(expr: str, pattern: re.Pattern) -> list[str]:
-    return re.split(
-        RE_NON_JP_PART,
-        string=re.sub(pattern, mark_non_jp_token, expr),
-    )
+    return RE_FURIGANA.sub(r"\g<1>", expr)
 
 
 def split_counters(text: str) -> Iterable[ParseableToken]:
@@ -81,25 +80,18 @@ def split_counters(text: str) -> Iterable[ParseableToken]:
             yield ParseableToken(part)
 
 
-def _tokenize(expr: str, *, split_regexes: Sequence[re.Pattern]) -> Iterable[Token]:
-    if not split_regexes:
-        yield from split_counters(expr.replace(" ", ""))
-    else:
-        for part in parts(expr, split_regexes[0]):
-            if part:
-                if m := re.fullmatch(RE_NON_JP_PARSED, part):
-                    yield Token(m.group("token"))
-                else:
-                    yield from _tokenize(part, split_regexes=split_regexes[1:])
-
-
 def tokenize(expr: str) -> Iterable[Token]:
     """
     Splits expr to tokens.
     Each token can be either parseable with mecab or not.
     Furigana is removed from parseable tokens, if present.
     """
-    return _tokenize(
-        expr=clean_furigana(expr),
-        split_regexes=(HTML_AND_MEDIA_REGEX, RE_NON_JP, RE_JP_SEP),
-    )
+    expr = clean_furigana(expr)
+    pos = 0
+    for m in RE_NOT_PARSEABLE.finditer(expr):
+        if m.start() > pos:
+            yield from split_counters(expr[pos : m.start()])
+        yield Token(m.group())
+        pos = m.end()
+    if pos < len(expr):
+        yield from split_counters(expr[pos:])
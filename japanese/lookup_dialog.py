@@ -1,7 +1,7 @@
 # Copyright: Ren Tatsumoto <tatsu at autistici.org> and contributors
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
-import io
+import functools
 from collections.abc import Sequence
 from gettext import gettext as _
 from typing import Optional
@@ -15,6 +15,7 @@ from aqt.webview import AnkiWebView
 from .ajt_common.about_menu import menu_root_entry, tweak_window
 from .config_view import config_view as cfg
 from .helpers.consts import ADDON_NAME
+from .helpers.profiles import PitchOutputFormat
 from .helpers.tokens import clean_furigana
 from .helpers.webview_utils import anki_addon_web_relpath
 from .pitch_accents.common import AccentDict, FormattedEntry
@@ -23,8 +24,25 @@ from .reading import format_pronunciations, get_notation, lookup
 ACTION_NAME = "Pitch Accent lookup"
 
 
-def entries_to_html(entries: Sequence[FormattedEntry]) -> Sequence[str]:
-    return tuple(dict.fromkeys(get_notation(entry, mode=cfg.pitch_accent.lookup_pitch_format) for entry in entries))
+@functools.lru_cache(maxsize=cfg.cache_lookups)
+def _entries_to_html(entries: tuple[FormattedEntry, ...], mode: PitchOutputFormat) -> str:
+    notations = dict.fromkeys(get_notation(entry, mode=mode) for entry in entries)
+    return "<ol>" + "".join(f"<li>{notation}</li>" for notation in notations) + "</ol>"
+
+
+def entries_to_html(entries: Sequence[FormattedEntry]) -> str:
+    """
+    Format entries as an HTML list, removing duplicates.
+    """
+    return _entries_to_html(tuple(entries), cfg.pitch_accent.lookup_pitch_format)
+
+
+def clear_cached_html() -> None:
+    """
+    Forget formatted entries.
+    Called when the user changes settings that affect how pitch accents are drawn.
+    """
+    _entries_to_html.cache_clear()
 
 
 class ViewPitchAccentsDialog(QDialog):
@@ -86,18 +104,13 @@ class ViewPitchAccentsDialog(QDialog):
         """Create HTML body"""
         assert self._pronunciations is not None, "Populate pronunciations first."
 
-        html = io.StringIO()
-        html.write('<main class="ajt__pitch_lookup">')
+        parts: list[str] = ['<main class="ajt__pitch_lookup">']
         for word, entries in self._pronunciations.items():
-            html.write(f'<div class="keyword">{word}</div>')
-            html.write('<div class="pitch_accents">')
-            html.write("<ol>")
-            for entry in entries_to_html(entries):
-                html.write(f"<li>{entry}</li>")
-            html.write("</ol>")
-            html.write(f"</div>")
-        html.write("</main>")
-        return html.getvalue()
+            parts.append(f'<div class="keyword">{word}</div><div class="pitch_accents">')
+            parts.append(entries_to_html(entries))
+            parts.append("</div>")
+        parts.append("</main>")
+        return "".join(parts)
 
     def set_html_result(self):
         """Format pronunciations as an HTML list."""
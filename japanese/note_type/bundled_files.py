@@ -9,10 +9,12 @@ from .consts import AJT_JAPANESE_CSS_PATH, AJT_JAPANESE_JS_PATH
 RE_VERSION_STR = re.compile(r"AJT Japanese (?P<type>JS|CSS) (?P<version>\d+\.\d+\.\d+\.\d+)\n")
 FileVersion = tuple[int, int, int, int]
 UNK_VERSION: FileVersion = 0, 0, 0, 0
+# The version string is written in the comment at the top of the file.
+VERSION_HEADER_SIZE = 256
 
 
 def parse_version_str(file_content: str):
-    m = re.search(RE_VERSION_STR, file_content)
+    m = RE_VERSION_STR.search(file_content)
     if not m:
         return UNK_VERSION
     return tuple(int(value) for value in m.group("version").split("."))
@@ -21,7 +23,7 @@ def parse_version_str(file_content: str):
 def get_file_version(file_path) -> FileVersion:
     try:
         with open(file_path, encoding="utf-8") as rf:
-            return parse_version_str(rf.read())
+            return parse_version_str(rf.read(VERSION_HEADER_SIZE))
     except FileNotFoundError:
         pass
     return UNK_VERSION
@@ -4,11 +4,20 @@ import re
 
 from .bundled_files import BUNDLED_CSS_FILE, BUNDLED_JS_FILE
 
+AJT_FILE_NAME_PREFIX = "_ajt_japanese"
 RE_AJT_CSS_IMPORT = re.compile(r'@import url\("_ajt_japanese[^"]*\.css"\);')
 RE_AJT_JS_IMPORT = re.compile(r'<script defer src="_ajt_japanese[^"]*\.js"></script>')
 
-assert re.fullmatch(RE_AJT_CSS_IMPORT, BUNDLED_CSS_FILE.import_str)
-assert re.fullmatch(RE_AJT_JS_IMPORT, BUNDLED_JS_FILE.import_str)
+assert RE_AJT_CSS_IMPORT.fullmatch(BUNDLED_CSS_FILE.import_str)
+assert RE_AJT_JS_IMPORT.fullmatch(BUNDLED_JS_FILE.import_str)
+
+
+def has_outdated_imports(text: str, pattern: re.Pattern[str], import_str: str) -> bool:
+    """
+    Returns True if the text imports a version of the file other than the bundled one.
+    Unlike substituting and comparing, this doesn't build a new string in the common (up-to-date) case.
+    """
+    return any(m.group() != import_str for m in pattern.finditer(text))
 
 
 def ensure_css_imported(model_dict: dict[str, str]) -> bool:
@@ -16,10 +25,12 @@ def ensure_css_imported(model_dict: dict[str, str]) -> bool:
     Takes a model (note type) and ensures that it imports the bundled CSS file.
     Returns True if the model has been modified and Anki needs to save the changes.
     """
-    updated_css = re.sub(RE_AJT_CSS_IMPORT, BUNDLED_CSS_FILE.import_str, model_dict["css"])
-    if updated_css != model_dict["css"]:
+    # Skip the scan if no version of the file could have been imported.
+    if AJT_FILE_NAME_PREFIX in model_dict["css"] and has_outdated_imports(
+        model_dict["css"], RE_AJT_CSS_IMPORT, BUNDLED_CSS_FILE.import_str
+    ):
         # The CSS was imported previously, but a new version has been released.
-        model_dict["css"] = updated_css
+        model_dict["css"] = RE_AJT_CSS_IMPORT.sub(BUNDLED_CSS_FILE.import_str, model_dict["css"])
         return True
     if BUNDLED_CSS_FILE.import_str not in model_dict["css"]:
         # The CSS was not imported before. Likely a fresh Note Type or Anki install.
@@ -33,10 +44,12 @@ def ensure_js_imported(template: dict[str, str], side: str) -> bool:
     Takes a card template (from a note type) and ensures that it imports the bundled JS file.
     Returns True if the template has been modified and Anki needs to save the changes.
     """
-    updated_js = re.sub(RE_AJT_JS_IMPORT, BUNDLED_JS_FILE.import_str, template[side])
-    if updated_js != template[side]:
+    # Skip the scan if no version of the file could have been imported.
+    if AJT_FILE_NAME_PREFIX in template[side] and has_outdated_imports(
+        template[side], RE_AJT_JS_IMPORT, BUNDLED_JS_FILE.import_str
+    ):
         # The JS was imported previously, but a new version has been released.
-        template[side] = updated_js
+        template[side] = RE_AJT_JS_IMPORT.sub(BUNDLED_JS_FILE.import_str, template[side])
         return True
     if BUNDLED_JS_FILE.import_str not in template[side]:
         # The JS was not imported before. Likely a fresh Note Type or Anki install.
@@ -1,6 +1,5 @@
 # Copyright: Ajatt-Tools and contributors; https://github.com/Ajatt-Tools
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
-import glob
 import os.path
 from collections.abc import Sequence
 
@@ -17,11 +16,15 @@ from .note_type.bundled_files import (
     BundledNoteTypeSupportFile,
     get_file_version,
 )
-from .note_type.imports import ensure_css_imported, ensure_js_imported
+from .note_type.imports import (
+    AJT_FILE_NAME_PREFIX,
+    ensure_css_imported,
+    ensure_js_imported,
+)
 
 
 def not_recent_version(file: BundledNoteTypeSupportFile) -> bool:
-    return get_file_version(file.file_path) > get_file_version(file.path_in_col())
+    return file.version > get_file_version(file.path_in_col())
 
 
 def save_to_col(file: BundledNoteTypeSupportFile) -> None:
@@ -83,9 +86,23 @@ def ensure_imports_added() -> None:
     CollectionOp(mw, lambda col: ensure_imports_added_op(col)).success(lambda _: None).run_in_background()
 
 
+def find_ajt_file_names_in_collection() -> frozenset[str]:
+    """
+    Return names of the add-on's files saved in the collection media folder (all versions).
+    Media folders can hold tens of thousands of files, so entries are filtered by name before anything else.
+    """
+    assert mw
+    with os.scandir(mw.col.media.dir()) as it:
+        return frozenset(
+            entry.name
+            for entry in it
+            if entry.name.startswith(AJT_FILE_NAME_PREFIX) and "." in entry.name and entry.is_file()
+        )
+
+
 def remove_old_versions() -> None:
     assert mw
-    all_ajt_file_names = frozenset(glob.glob("_ajt_japanese*.*", root_dir=mw.col.media.dir()))
+    all_ajt_file_names = find_ajt_file_names_in_collection()
     current_ajt_file_names = frozenset((BUNDLED_JS_FILE.name_in_col, BUNDLED_CSS_FILE.name_in_col))
     for old_file_name in all_ajt_file_names - current_ajt_file_names:
         os.unlink(os.path.join(mw.col.media.dir(), old_file_name))
@@ -136,6 +136,9 @@ class AddAudio(DoTask, task_type=ProfileAudio):
 
 def html_to_media_line(txt: str) -> str:
     """Strip HTML but keep media filenames."""
+    if "<" not in txt and "&" not in txt:
+        # Plain text: there are no tags, media or entities to strip. Skip the call to Anki.
+        return txt.replace("\n", " ").strip()
     return strip_html_media(
         txt.replace("<br>", " ")
         .replace("<br/>", " ")
@@ -13,13 +13,12 @@ from ..helpers.consts import CFG_WORD_SEP
 NARROW_WIDGET_MAX_WIDTH = 96
 
 
-class WordsEdit(QTextEdit):
+class WordsEdit(QPlainTextEdit):
     _min_height = 32
     _font_size = 16
 
     def __init__(self, initial_values: Sequence[str]):
         super().__init__()
-        self.setAcceptRichText(False)
         self.set_values(initial_values)
         self.setMinimumHeight(self._min_height)
         self._adjust_font_size()